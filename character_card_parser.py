@@ -1,33 +1,189 @@
 # character_card_parser.py
 import png
-import base64
 import json
-import io
+import os
 import struct
 import zlib  # Needed for CRC calculation
-from typing import List, Tuple, Optional
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple, Optional
 
 # Import astrbot logger
 from astrbot.api import logger
 
+# pybase64 uses SIMD kernels for large payloads; fall back to the standard library
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# orjson is considerably faster than the standard json module when installed
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+_V3_SPEC_FIELDS = b'"spec":"chara_card_v3","spec_version":"3.0"'
+
 def _find_chunks(chunks: List[Tuple[bytes, bytes]], name: bytes) -> List[Tuple[bytes, bytes]]:
     """查找指定名称的 PNG 块"""
     return [chunk for chunk in chunks if chunk[0] == name]
 
-def _decode_text_chunk(chunk_data: bytes) -> Tuple[str, str]:
-    """解码 tEXt 块数据"""
-    keyword, text = chunk_data.split(b'\x00', 1)
-    return keyword.decode('iso-8859-1'), text.decode('iso-8859-1')
-
 def _encode_text_chunk(keyword: str, text: str) -> bytes:
     """编码 tEXt 块数据"""
     return keyword.encode('iso-8859-1') + b'\x00' + text.encode('iso-8859-1')
 
+def json_loads(data):
+    """解析 JSON (str 或 UTF-8 bytes)，可用时使用 orjson"""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps_pretty(obj) -> bytes:
+    """将对象序列化为缩进 2 格的 UTF-8 JSON 字节串，可用时使用 orjson"""
+    if _orjson is not None:
+        return _orjson.dumps(obj, option=_orjson.OPT_INDENT_2 | _orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+def _buffer_reader(buf) -> Callable[[int, int], bytes]:
+    """返回从字节流中读取 [start, stop) 区间的函数"""
+    def read_range(start: int, stop: int) -> bytes:
+        return bytes(buf[start:stop])
+    return read_range
+
+def _file_reader(f: BinaryIO) -> Callable[[int, int], bytes]:
+    """返回通过 seek/read 从已打开文件中读取 [start, stop) 区间的函数"""
+    def read_range(start: int, stop: int) -> bytes:
+        f.seek(start)
+        data = f.read(stop - start)
+        if len(data) != stop - start:
+            # 文件在读取过程中被截断
+            raise png.Error(f"Unexpected end of file at offset {start + len(data)}")
+        return data
+    return read_range
+
+def _iter_chunk_offsets(read_range: Callable[[int, int], bytes], end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    """
+    遍历 PNG 块的偏移信息，只读取 8 字节的块头，不读取块数据。
+    遇到 IEND 块后停止。
+
+    Args:
+        read_range: 读取 [start, stop) 区间字节的函数。
+        end: PNG 数据的总长度。
+
+    Yields:
+        (块类型, 数据起始偏移, 数据长度, CRC 起始偏移)
+
+    Raises:
+        png.Error: 如果块头或块数据被截断。
+    """
+    off = len(png.signature)
+    while off < end:
+        if off + 8 > end:
+            raise png.Error(f"Truncated PNG chunk header at offset {off}")
+        data_len, chunk_type = struct.unpack('>I4s', read_range(off, off + 8))
+        data_start = off + 8
+        crc_start = data_start + data_len
+        if crc_start + 4 > end:
+            raise png.Error(f"Truncated PNG chunk {chunk_type!r} at offset {off}")
+        yield chunk_type, data_start, data_len, crc_start
+        if chunk_type == b'IEND':
+            return
+        off = crc_start + 4
+
+def _iter_png_offsets(buf) -> Iterator[Tuple[bytes, int, int, int]]:
+    """遍历字节流 (任何支持缓冲区协议的对象) 中 PNG 块的偏移信息，参见 _iter_chunk_offsets"""
+    return _iter_chunk_offsets(_buffer_reader(buf), len(buf))
+
+def _build_chunk(chunk_type: bytes, chunk_data: bytes) -> bytearray:
+    """
+    构造完整的 PNG 块 (长度 + 类型 + 数据 + CRC)。
+    直接返回预分配的缓冲区，由调用者拼接，避免再复制一次。
+    """
+    # Each chunk: length (4) + type (4) + data + CRC (4)
+    data_len = len(chunk_data)
+    buf = bytearray(12 + data_len)
+    mv = memoryview(buf)
+    # Pack length (Big-endian unsigned integer, 4 bytes)
+    struct.pack_into('>I', buf, 0, data_len)
+    # Write chunk type and chunk data
+    mv[4:8] = chunk_type
+    mv[8:8 + data_len] = chunk_data
+    # Calculate and write CRC (Big-endian unsigned integer, 4 bytes)
+    # CRC is calculated over the chunk type and chunk data bytes, incrementally to avoid concatenation
+    crc = zlib.crc32(chunk_data, zlib.crc32(chunk_type))
+    struct.pack_into('>I', buf, 8 + data_len, crc & 0xffffffff)
+    mv.release()
+    return buf
+
+def _text_chunk_keyword(buf, data_start: int, crc_start: int) -> Optional[bytes]:
+    """读取 tEXt 块的小写关键字 (不解码文本内容)，格式错误时返回 None"""
+    # PNG keywords are at most 79 bytes
+    nul = buf.find(b'\x00', data_start, min(crc_start, data_start + 80))
+    if nul < 0:
+        return None
+    return bytes(buf[data_start:nul]).lower()
+
+def _inject_spec_fields(data: bytes) -> bytes:
+    """
+    为 v3 数据注入 'spec' 和 'spec_version' 字段。
+    数据总会先用可用的解析器校验；字段不存在时直接在开头的 '{' 后插入文本，省去重新序列化。
+
+    Args:
+        data: 角色数据 (UTF-8 编码的 JSON)。
+
+    Returns:
+        注入字段后的 JSON (UTF-8 编码)。
+
+    Raises:
+        json.JSONDecodeError: 如果数据不是有效的 JSON。
+        TypeError: 如果数据不是 JSON 对象。
+    """
+    stripped = data.strip()
+    v3_data_dict = json_loads(stripped)
+    if (isinstance(v3_data_dict, dict) and stripped[:1] == b'{'
+            and 'spec' not in v3_data_dict and 'spec_version' not in v3_data_dict):
+        body = stripped[1:]
+        separator = b'' if body.lstrip().startswith(b'}') else b','
+        return b'{' + _V3_SPEC_FIELDS + separator + body
+
+    # Existing spec fields or non-object data: full roundtrip
+    v3_data_dict['spec'] = 'chara_card_v3'
+    v3_data_dict['spec_version'] = '3.0'
+    if _orjson is not None:
+        return _orjson.dumps(v3_data_dict)
+    return json.dumps(v3_data_dict).encode('utf-8')
+
+def _build_metadata_chunks(data: str) -> List[bytearray]:
+    """
+    构造 'chara' (v2) 和 'ccv3' (v3) tEXt 块。
+    如果无法创建 v3 块，只返回 v2 块。
+    """
+    # Encode once, shared by the v2 and v3 chunks
+    data_utf8 = data.encode('utf-8')
+
+    # Prepare v2 data
+    base64_encoded_v2_data = _b64.b64encode(data_utf8).decode('ascii')
+    v2_chunk_data = _encode_text_chunk('chara', base64_encoded_v2_data)
+    new_chunks = [_build_chunk(b'tEXt', v2_chunk_data)]
+
+    # Prepare v3 data
+    try:
+        v3_json_bytes = _inject_spec_fields(data_utf8)
+        base64_encoded_v3_data = _b64.b64encode(v3_json_bytes).decode('ascii')
+        v3_chunk_data = _encode_text_chunk('ccv3', base64_encoded_v3_data)
+        new_chunks.append(_build_chunk(b'tEXt', v3_chunk_data))
+    except json.JSONDecodeError as e:
+        logger.warning(f"Could not create v3 chunk, invalid JSON data: {e}")
+    except Exception as e:
+        logger.warning(f"Could not create v3 chunk: {e}")
+
+    return new_chunks
+
 def write_metadata(image_bytes: bytes, data: str) -> bytes:
     """
     将角色元数据写入 PNG 图片字节流。
     同时写入 'chara' (v2) 和 'ccv3' (v3) 块。
-    This version manually reconstructs the PNG from chunks.
+    This version walks the chunk offsets directly and copies untouched chunks as-is,
+    including their original CRCs; only the new tEXt chunks have a CRC computed.
 
     Args:
         image_bytes: PNG 图片的字节流。
@@ -37,157 +193,182 @@ def write_metadata(image_bytes: bytes, data: str) -> bytes:
         带有元数据的 PNG 图片字节流。
 
     Raises:
-        png.Error: 如果 PNG 无效或缺少 IHDR 块。
+        png.Error: 如果 PNG 无效或块被截断。
         ValueError: 如果输入数据不是有效的 JSON 字符串 (当尝试创建 v3 块时)。
     """
     # Check PNG signature
     if not image_bytes.startswith(png.signature):
         raise png.Error("Not a valid PNG file (incorrect signature)")
 
-    reader = png.Reader(bytes=image_bytes)
+    src = memoryview(image_bytes)
+
+    # Collect byte spans to keep, skipping old 'chara' and 'ccv3' tEXt chunks.
+    # Consecutive kept chunks are merged into a single span. Spans cover whole
+    # chunks (length, type, data and CRC), so pass-through CRCs are never recomputed.
+    keep_spans = []
+    span_start = 0
+    iend_start = -1
+    end = len(png.signature)
     try:
-        # Read chunks without processing pixel data
-        original_chunks = list(reader.chunks())
+        for chunk_type, data_start, data_len, crc_start in _iter_png_offsets(image_bytes):
+            chunk_start = data_start - 8
+            end = crc_start + 4
+            if chunk_type == b'IEND':
+                iend_start = chunk_start
+            elif chunk_type == b'tEXt':
+                # Only the keyword is needed here
+                keyword = _text_chunk_keyword(image_bytes, data_start, crc_start)
+                if keyword is None:  # If the keyword is malformed, keep the original chunk
+                    logger.warning("Failed to decode tEXt chunk during filtering, keeping original: missing keyword separator")
+                    continue
+                if keyword in (b'chara', b'ccv3'):
+                    if span_start < chunk_start:
+                        keep_spans.append((span_start, chunk_start))
+                    span_start = end
+            # Keep all other chunks (including IHDR, IDAT, IEND, etc.)
     except png.Error as e:
         logger.error(f"Error reading PNG chunks: {e}")
         raise
 
-    # Filter out old 'chara' and 'ccv3' tEXt chunks
-    new_chunks = []
-    for chunk_type, chunk_data in original_chunks:
-        if chunk_type == b'tEXt':
-            try:
-                keyword, _ = _decode_text_chunk(chunk_data)
-                if keyword.lower() not in ('chara', 'ccv3'):
-                    new_chunks.append((chunk_type, chunk_data))
-            except Exception as e:  # If decoding fails, keep the original chunk
-                logger.warning(f"Failed to decode tEXt chunk during filtering, keeping original: {e}")
-                new_chunks.append((chunk_type, chunk_data))
-        else:
-            # Keep all non-tEXt chunks (including IHDR, IDAT, IEND, etc.)
-            new_chunks.append((chunk_type, chunk_data))
-
-    # Prepare v2 data
-    base64_encoded_v2_data = base64.b64encode(data.encode('utf-8')).decode('ascii')
-    v2_chunk_data = _encode_text_chunk('chara', base64_encoded_v2_data)
-    v2_chunk_tuple = (b'tEXt', v2_chunk_data)
+    new_chunks = _build_metadata_chunks(data)
 
-    # Prepare v3 data
-    v3_chunk_tuple = None
-    try:
-        v3_data_dict = json.loads(data)
-        v3_data_dict['spec'] = 'chara_card_v3'
-        v3_data_dict['spec_version'] = '3.0'
-        v3_json_string = json.dumps(v3_data_dict)
-        base64_encoded_v3_data = base64.b64encode(v3_json_string.encode('utf-8')).decode('ascii')
-        v3_chunk_data = _encode_text_chunk('ccv3', base64_encoded_v3_data)
-        v3_chunk_tuple = (b'tEXt', v3_chunk_data)
-    except json.JSONDecodeError as e:
-        logger.warning(f"Could not create v3 chunk, invalid JSON data: {e}")
-    except Exception as e:
-        logger.warning(f"Could not create v3 chunk: {e}")
-
-    # Find IEND chunk index to insert before it
-    iend_index = -1
-    for i, (chunk_type, _) in enumerate(new_chunks):
-        if chunk_type == b'IEND':
-            iend_index = i
-            break
-
-    if iend_index != -1:
+    if iend_start != -1:
         # Insert new chunks before IEND
-        insert_pos = iend_index
-        new_chunks.insert(insert_pos, v2_chunk_tuple)
-        if v3_chunk_tuple:
-            new_chunks.insert(insert_pos + 1, v3_chunk_tuple)
+        if span_start < iend_start:
+            keep_spans.append((span_start, iend_start))
+        parts = [src[s:e] for s, e in keep_spans]
+        parts.extend(new_chunks)
+        parts.append(src[iend_start:end])
     else:
         logger.warning("IEND chunk not found. Appending metadata chunks.")
-        new_chunks.append(v2_chunk_tuple)
-        if v3_chunk_tuple:
-            new_chunks.append(v3_chunk_tuple)
+        if span_start < end:
+            keep_spans.append((span_start, end))
+        parts = [src[s:e] for s, e in keep_spans]
+        parts.extend(new_chunks)
         # Consider adding a dummy IEND if missing, but for now just append.
 
-    # Manually reconstruct the PNG byte stream
-    output_buffer = io.BytesIO()
-    output_buffer.write(png.signature)  # Write the signature first
-
-    for chunk_type, chunk_data in new_chunks:
-        # Pack length (Big-endian unsigned integer, 4 bytes)
-        output_buffer.write(struct.pack('>I', len(chunk_data)))
-        # Write chunk type
-        output_buffer.write(chunk_type)
-        # Write chunk data
-        output_buffer.write(chunk_data)
-        # Calculate and write CRC (Big-endian unsigned integer, 4 bytes)
-        # CRC is calculated over the chunk type and chunk data bytes
-        crc = zlib.crc32(chunk_type + chunk_data)
-        output_buffer.write(struct.pack('>I', crc))
+    return b''.join(parts)
 
-    return output_buffer.getvalue()
-
-def read_metadata(image_bytes: bytes) -> Optional[str]:
+def _scan_text_chunks(read_range: Callable[[int, int], bytes], end: int) -> Tuple[Dict[bytes, bytes], bool]:
     """
-    从 PNG 图片字节流中读取角色元数据。
-    优先读取 V3 ('ccv3')，其次读取 V2 ('chara')。
+    只扫描 tEXt 块，收集 'chara' 和 'ccv3' 的文本内容，其余块仅跳过块头。
+    收集的块会校验 CRC；同一关键字出现多次时以最后一个块为准，扫描到 IEND 为止。
 
     Args:
-        image_bytes: PNG 图片的字节流。
+        read_range: 读取 [start, stop) 区间字节的函数。
+        end: PNG 数据的总长度。
 
     Returns:
-        角色数据字符串 (JSON)，如果未找到则返回 None。
+        ({小写关键字: 文本字节}, 是否包含可解码的 tEXt 块)
 
     Raises:
-        png.Error: 如果输入字节不是有效的 PNG。
-        ValueError: 如果找到的块数据无法解码。
+        png.Error: 如果块头或块数据被截断，或收集的块 CRC 不匹配。
     """
+    found = {}
+    has_text = False
+    for chunk_type, data_start, data_len, crc_start in _iter_chunk_offsets(read_range, end):
+        if chunk_type != b'tEXt':
+            continue
+        # 一次读取块数据和 CRC
+        chunk = read_range(data_start, crc_start + 4)
+        keyword = _text_chunk_keyword(chunk, 0, data_len)
+        if keyword is None:
+            logger.warning("Could not decode tEXt chunk: missing keyword separator")
+            continue  # 跳过无法解码的块
+        has_text = True
+        if keyword in (b'chara', b'ccv3'):
+            # 只校验实际返回的块的 CRC，开销与元数据大小成正比
+            stored_crc, = struct.unpack_from('>I', chunk, data_len)
+            actual_crc = zlib.crc32(memoryview(chunk)[:data_len], zlib.crc32(b'tEXt'))
+            if stored_crc != actual_crc:
+                raise png.ChunkError(f"Checksum error in tEXt chunk: 0x{stored_crc:08X} != 0x{actual_crc:08X}.")
+            # 同一关键字出现多次时后面的块覆盖前面的 (如编辑器追加保存的新数据)
+            found[keyword] = chunk[len(keyword) + 1:data_len]
+    return found, has_text
+
+def _read_metadata_bytes(read_range: Callable[[int, int], bytes], end: int) -> Optional[bytes]:
+    """read_metadata_bytes 的实现，数据通过 read_range 按需读取"""
     try:
-        reader = png.Reader(bytes=image_bytes)
-        chunks = list(reader.chunks())
+        # Check PNG signature
+        if end < len(png.signature) or read_range(0, len(png.signature)) != png.signature:
+            raise png.Error("Not a valid PNG file (incorrect signature)")
+        text_chunks_data, has_text = _scan_text_chunks(read_range, end)
     except png.Error as e:
         logger.error(f"Error reading PNG: {e}")
         raise
 
-    text_chunks_data = {}
-    for chunk_type, chunk_data in chunks:
-        if chunk_type == b'tEXt':
-            try:
-                keyword, text = _decode_text_chunk(chunk_data)
-                text_chunks_data[keyword.lower()] = text
-            except Exception as e:
-                logger.warning(f"Could not decode tEXt chunk: {e}")
-                continue  # 跳过无法解码的块
-
-    if not text_chunks_data:
+    if not has_text:
         logger.info("PNG metadata does not contain any text chunks.")
         return None
 
     # 优先 V3
-    if 'ccv3' in text_chunks_data:
+    if b'ccv3' in text_chunks_data:
         try:
-            return base64.b64decode(text_chunks_data['ccv3']).decode('utf-8')
+            return _b64.b64decode(text_chunks_data[b'ccv3'])
         except Exception as e:
             raise ValueError(f"Error decoding base64 for ccv3 chunk: {e}")
 
     # 其次 V2
-    if 'chara' in text_chunks_data:
+    if b'chara' in text_chunks_data:
         try:
-            return base64.b64decode(text_chunks_data['chara']).decode('utf-8')
+            return _b64.b64decode(text_chunks_data[b'chara'])
         except Exception as e:
             raise ValueError(f"Error decoding base64 for chara chunk: {e}")
 
     logger.info("PNG metadata does not contain any character data ('chara' or 'ccv3').")
     return None
 
-def parse_card(card_path: str, file_format: str = 'png') -> Optional[str]:
+def read_metadata_bytes(image_bytes: bytes) -> Optional[bytes]:
+    """
+    从 PNG 图片字节流中读取角色元数据，返回未解码的 UTF-8 字节串。
+    优先读取 V3 ('ccv3')，其次读取 V2 ('chara')。
+
+    Args:
+        image_bytes: PNG 图片的字节流 (任何支持缓冲区协议的对象)。
+
+    Returns:
+        角色数据 (UTF-8 编码的 JSON)，如果未找到则返回 None。
+
+    Raises:
+        png.Error: 如果输入字节不是有效的 PNG。
+        ValueError: 如果找到的块数据无法解码。
+    """
+    return _read_metadata_bytes(_buffer_reader(image_bytes), len(image_bytes))
+
+def read_metadata(image_bytes: bytes) -> Optional[str]:
+    """
+    从 PNG 图片字节流中读取角色元数据。
+    优先读取 V3 ('ccv3')，其次读取 V2 ('chara')。
+
+    Args:
+        image_bytes: PNG 图片的字节流 (任何支持缓冲区协议的对象)。
+
+    Returns:
+        角色数据字符串 (JSON)，如果未找到则返回 None。
+
+    Raises:
+        png.Error: 如果输入字节不是有效的 PNG。
+        ValueError: 如果找到的块数据无法解码。
+    """
+    data = read_metadata_bytes(image_bytes)
+    if data is None:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ValueError(f"Error decoding character data as UTF-8: {e}")
+
+def parse_card(card_path: str, file_format: str = 'png') -> Optional[bytes]:
     """
     解析卡片图片文件并返回角色元数据。
+    返回未解码的 UTF-8 字节串，可直接交给 JSON 解析器。
 
     Args:
         card_path: 卡片图片的文件路径。
         file_format: 文件格式 (目前仅支持 'png')。
 
     Returns:
-        角色数据字符串 (JSON)，如果未找到或格式不支持则返回 None。
+        角色数据 (UTF-8 编码的 JSON)，如果未找到或格式不支持则返回 None。
 
     Raises:
         FileNotFoundError: 如果文件路径不存在。
@@ -199,8 +380,9 @@ def parse_card(card_path: str, file_format: str = 'png') -> Optional[str]:
 
     try:
         with open(card_path, 'rb') as f:
-            image_bytes = f.read()
-        return read_metadata(image_bytes)
+            # 只按偏移读取块头和 tEXt 块，而不是整体读入内存。
+            # 不使用 mmap: 卡片目录由用户直接放入文件，映射期间文件被截断会触发 SIGBUS 导致进程退出
+            return _read_metadata_bytes(_file_reader(f), os.fstat(f.fileno()).st_size)
     except FileNotFoundError:
         logger.error(f"Error: File not found at {card_path}")
         raise
@@ -219,22 +401,22 @@ if __name__ == '__main__':
 
     try:
         # 1. 从 PNG 文件解析元数据
-        character_json_string = parse_card(input_png_path)
+        character_json_bytes = parse_card(input_png_path)
 
-        if character_json_string:
+        if character_json_bytes:
             print("Successfully read metadata from PNG.")
             # 2. 将提取的 JSON 字符串写入文件
             print(f"Writing extracted data to JSON file: {output_json_path}")
             try:
                 # 尝试美化 JSON 输出
-                parsed_data = json.loads(character_json_string)
-                with open(output_json_path, 'w', encoding='utf-8') as f:
-                    json.dump(parsed_data, f, ensure_ascii=False, indent=2)
+                parsed_data = json_loads(character_json_bytes)
+                with open(output_json_path, 'wb') as f:
+                    f.write(_json_dumps_pretty(parsed_data))
             except json.JSONDecodeError:
                 print("Warning: Could not parse the extracted data as JSON. Writing raw string.")
-                # 如果无法解析为 JSON（理论上不应发生，除非元数据损坏），则直接写入原始字符串
-                with open(output_json_path, 'w', encoding='utf-8') as f:
-                    f.write(character_json_string)
+                # 如果无法解析为 JSON（理论上不应发生，除非元数据损坏），则直接写入原始数据
+                with open(output_json_path, 'wb') as f:
+                    f.write(character_json_bytes)
             print("Extracted data written to JSON successfully.")
         else:
             print(f"No character metadata found in {input_png_path} or error reading.")
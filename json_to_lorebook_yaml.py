@@ -2,22 +2,80 @@
 # -*- coding: utf-8 -*-
 
 import json
+import logging
 import yaml
 import os
 import re
 import argparse
 import sys
 import traceback
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 # Import astrbot logger
 from astrbot.api import logger
 
+class _ForceDoubleQuoteMixin:
+    """强制已手动加引号的字符串使用双引号 (或包含换行时使用字面量块风格)"""
+    def represent_scalar(self, tag, value, style=None):
+        if isinstance(value, str):
+            # 如果我们已经手动加了引号和转义，直接返回
+            if value.startswith('"') and value.endswith('"'):
+                if '\\n' in value[1:-1]: # 如果包含转义后的换行符，使用字面量块风格
+                    style = '|'
+                    processed_value = value[1:-1].replace('\\n', '\n').replace('\\"', '"')
+                    return super().represent_scalar(tag, processed_value, style=style)
+                else:
+                    style = '"'
+                    return super().represent_scalar(tag, value[1:-1], style=style)
+        return super().represent_scalar(tag, value, style)
+
+class ForceDoubleQuoteDumper(_ForceDoubleQuoteMixin, yaml.SafeDumper):
+    """强制已手动加引号的字符串使用双引号 (或包含换行时使用字面量块风格) 的 Dumper"""
+
+# 优先使用 libyaml 的 C 实现进行序列化，不可用时只使用纯 Python 实现。
+# libyaml 会把 BMP 以外的字符 (如 emoji) 以及 NEL/LS/PS 换行符转义为 \UXXXXXXXX、\N 等并放弃字面量块风格，
+# 遇到孤立的代理字符 (JSON 中的 \ud800 等) 会直接报错；
+# 对以换行结尾的块标量 (|、|+)，两者输出文档结束标记 "..." 的规则也不同。
+# 数据中含有这类字符串时仍回退到纯 Python 实现，保持输出与之前一致且便于手工编辑。
+try:
+    class _CForceDoubleQuoteDumper(_ForceDoubleQuoteMixin, yaml.CSafeDumper):
+        """ForceDoubleQuoteDumper 的 libyaml 版本"""
+except AttributeError:
+    _CForceDoubleQuoteDumper = None
+
+_LIBYAML_MISMATCH_RE = re.compile('[\x85\u2028\u2029\ud800-\udfff\U00010000-\U0010FFFF]|\\\\n"$')
+
 class LoreBookConverter:
     """
     SillyTavern 角色卡片 JSON 到 Lorebook YAML 格式的转换类
     提供更结构化和可靠的转换流程
     """
+
+    # 触发器字段顺序，与输出的 YAML 键顺序一致
+    # 转义表: 双引号 -> \", 换行符 -> \n, 移除 \r；内容字段额外将制表符替换为两个空格
+    _ESCAPE_TRANS = str.maketrans({'"': '\\"', '\n': '\\n', '\r': None})
+    _CONTENT_ESCAPE_TRANS = str.maketrans({'"': '\\"', '\n': '\\n', '\r': None, '\t': '  '})
+
+    # 循环不变的带引号常量，避免每个条目重复调用 quote_value
+    _QUOTED_EMPTY = '""'
+    _QUOTED_KEYWORDS = '"keywords"'
+    _QUOTED_SYS_START = '"sys_start"'
+
+    # 用于识别单个条目的常见属性
+    _ENTRY_KEYS = ("keys", "comment", "content", "insertion_order")
+
+    # position 映射: 0 -> "sys_start", 1 -> "sys_end", "after_char" -> "sys_start" 等
+    _POSITION_MAP = {
+        0: "sys_start",
+        1: "sys_end",
+        "0": "sys_start",
+        "1": "sys_end",
+        "after_char": "sys_start",  # 将 after_char 映射到 sys_start
+        "before_char": "sys_start", # 示例：添加其他可能的映射
+        "before_prompt": "sys_start",
+        "after_prompt": "sys_end"
+        # 可以根据需要添加更多映射
+    }
     
     def __init__(self):
         """初始化转换器"""
@@ -34,41 +92,42 @@ class LoreBookConverter:
         否则按原样返回。
         """
         if isinstance(value, str):
-            # 将内部的双引号转义为 \\""
-            escaped_value = value.replace('"', '\\"')
-            # 将换行符转义为 \\n，移除 \\r
-            escaped_value = escaped_value.replace('\n', '\\n').replace('\r', '') 
-            return f'"{escaped_value}"'
+            # 单次遍历完成双引号、换行符转义并移除 \\r
+            return '"' + value.translate(self._ESCAPE_TRANS) + '"'
         return value # Return non-strings as is
     
-    def clean_content(self, content: Any) -> Any:
-        """清理内容中的特殊字符，确保YAML格式正确"""
+    def quote_content(self, content: Any) -> Any:
+        """
+        与 quote_value 相同，但额外替换可能导致YAML解析问题的制表符。
+        清理和转义在同一次遍历中完成。
+        """
         if isinstance(content, str):
-            # 替换可能导致YAML解析问题的字符
-            return content.replace('\t', '  ')
+            return '"' + content.translate(self._CONTENT_ESCAPE_TRANS) + '"'
         return content
     
     def convert_position(self, pos_value) -> str:
         """转换position值: 0 -> "sys_start", 1 -> "sys_end", "after_char" -> "sys_start" 等"""
-        # 扩展映射以包含字符串值
-        position_map = {
-            0: "sys_start",
-            1: "sys_end",
-            "0": "sys_start",
-            "1": "sys_end",
-            "after_char": "sys_start",  # 将 after_char 映射到 sys_start
-            "before_char": "sys_start", # 示例：添加其他可能的映射
-            "before_prompt": "sys_start",
-            "after_prompt": "sys_end"
-            # 可以根据需要添加更多映射
-        }
         # 默认为 sys_start
-        return position_map.get(pos_value, "sys_start")
+        return self._POSITION_MAP.get(pos_value, "sys_start")
     
     def process_match(self, keys, keysecondary) -> str:
         """处理key和keysecondary，转换为匹配规则格式"""
         if not keys:
             return ""
+
+        # 快速路径: keys/keysecondary 已是字符串列表时直接 join，仅在含空字符串时过滤
+        if type(keys) is list and (not keysecondary or type(keysecondary) is list):
+            try:
+                primary = "&".join(filter(None, keys) if "" in keys else keys)
+                secondary = ""
+                if keysecondary:
+                    secondary = "&".join(filter(None, keysecondary) if "" in keysecondary else keysecondary)
+            except TypeError:
+                pass # 含有非字符串元素，回退到通用路径
+            else:
+                if primary and secondary:
+                    return f"{primary}~{secondary}"
+                return primary
         
         # 处理主关键词 - 确保keys是列表
         if isinstance(keys, str):
@@ -115,11 +174,8 @@ class LoreBookConverter:
             keysecondary = entry.get("secondary_keys", []) 
             raw_entry_match = self.process_match(keys, keysecondary)
             
-            # 处理位置 - 使用 'position'
-            raw_entry_position = self.convert_position(entry.get("position", "after_char")) 
-            
-            # 处理内容
-            raw_entry_content = self.clean_content(entry.get("content", ""))
+            # 处理位置 - 使用 'position'，缺失时与 after_char 一样映射为 sys_start
+            raw_entry_position = self.convert_position(entry.get("position")) 
             
             # 处理优先级 (100 - order) - 使用 'insertion_order'
             entry_order = entry.get("insertion_order", 100) 
@@ -152,10 +208,14 @@ class LoreBookConverter:
             # --- 应用 quote_value ---
             quoted_entry_name = self.quote_value(raw_entry_name)
             quoted_entry_match = self.quote_value(raw_entry_match)
-            quoted_entry_conditional = self.quote_value("") 
-            quoted_entry_content = self.quote_value(raw_entry_content)
-            quoted_entry_type = self.quote_value("keywords") # 对硬编码的 "keywords" 应用
-            quoted_entry_position = self.quote_value(raw_entry_position) # 对转换后的 position 值应用
+            quoted_entry_conditional = self._QUOTED_EMPTY
+            quoted_entry_content = self.quote_content(entry.get("content", ""))
+            quoted_entry_type = self._QUOTED_KEYWORDS # 硬编码的 "keywords"
+            # 对转换后的 position 值应用，最常见的 sys_start 直接使用常量
+            if raw_entry_position == "sys_start":
+                quoted_entry_position = self._QUOTED_SYS_START
+            else:
+                quoted_entry_position = self.quote_value(raw_entry_position)
                 
             # 构建触发器 - 使用带引号的值
             trigger = {
@@ -170,71 +230,88 @@ class LoreBookConverter:
                 "content": quoted_entry_content
             }
             
-            logger.debug(f"成功处理条目 {entry_id}: {raw_entry_name}") # 日志中使用原始名称
+            logger.debug("成功处理条目 %s: %s", entry_id, raw_entry_name) # 日志中使用原始名称
             return trigger
             
         except Exception as e:
             logger.error(f"处理条目 {entry_id} 时出错: {e}")
-            logger.debug(traceback.format_exc())
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(traceback.format_exc())
             return None
     
+    def _detect_schema(self, data: Dict[str, Any]) -> Tuple[str, Any]:
+        """一次性识别JSON数据的结构，返回 (结构标签, 条目集合)"""
+        # 情况 -1: data['data']['character_book']['entries'] 数组
+        nested = data.get('data')
+        if isinstance(nested, dict):
+            book = nested.get('character_book')
+            if isinstance(book, dict) and isinstance(book.get('entries'), list):
+                return "v3_nested", book['entries']
+
+        # 情况0: character_book.entries 数组
+        book = data.get('character_book')
+        if isinstance(book, dict) and isinstance(book.get('entries'), list):
+            return "character_book", book['entries']
+
+        # 情况1: entries 字典
+        entries = data.get('entries')
+        if isinstance(entries, dict):
+            return "entries_dict", entries
+
+        # 情况2: 具有常见的条目属性
+        if any(key in data for key in self._ENTRY_KEYS):
+            return "single_entry", data
+
+        return "unknown", data
+
     def extract_entries_from_json(self, data: Dict[str, Any], source_file: str = "") -> List[Dict[str, Any]]:
         """从JSON数据中提取条目"""
         triggers = []
         
-        # 情况 -1: 检查 data['data']['character_book']['entries'] 路径 (新添加)
-        if 'data' in data and isinstance(data['data'], dict) and \
-           'character_book' in data['data'] and isinstance(data['data']['character_book'], dict) and \
-           'entries' in data['data']['character_book'] and isinstance(data['data']['character_book']['entries'], list):
-            
-            entries_list = data['data']['character_book']['entries']
-            logger.debug(f"找到 data['data']['character_book']['entries'] 数组，包含 {len(entries_list)} 个条目")
-            
-            for i, entry in enumerate(entries_list):
-                # 使用 entry 的 'id' 字段（如果存在）作为 entry_id，否则使用索引 i
-                entry_id_from_json = entry.get('id', i) 
-                trigger = self.process_entry(entry_id_from_json, entry)
-                if trigger:
-                    triggers.append(trigger)
-                    self.entries_processed += 1
-            
-            return triggers
+        schema, entries = self._detect_schema(data)
+        match schema:
+            case "v3_nested":
+                # 情况 -1: data['data']['character_book']['entries'] 路径
+                logger.debug("找到 data['data']['character_book']['entries'] 数组，包含 %d 个条目", len(entries))
+                for i, entry in enumerate(entries):
+                    # 使用 entry 的 'id' 字段（如果存在）作为 entry_id，否则使用索引 i
+                    entry_id_from_json = entry.get('id', i) 
+                    trigger = self.process_entry(entry_id_from_json, entry)
+                    if trigger:
+                        triggers.append(trigger)
+                        self.entries_processed += 1
+                return triggers
 
-        # 情况0: 有character_book.entries数组，新的SillyTavern格式 (保持原有逻辑作为备选)
-        if 'character_book' in data and isinstance(data['character_book'], dict) and 'entries' in data['character_book'] and isinstance(data['character_book']['entries'], list):
-            entries_list = data['character_book']['entries']
-            logger.debug(f"找到character_book.entries数组，包含 {len(entries_list)} 个条目")
-            
-            for i, entry in enumerate(entries_list):
-                trigger = self.process_entry(i, entry)
-                if trigger:
-                    triggers.append(trigger)
-                    self.entries_processed += 1
-            
-            return triggers
-        
-        # 情况1: 有entries字段，标准SillyTavern格式 (保持原有逻辑作为备选)
-        if 'entries' in data and isinstance(data['entries'], dict):
-            entries = data['entries']
-            logger.debug(f"找到entries字段，包含 {len(entries)} 个条目")
-            
-            for entry_id, entry in entries.items():
-                trigger = self.process_entry(entry_id, entry)
+            case "character_book":
+                # 情况0: 有character_book.entries数组，新的SillyTavern格式
+                logger.debug("找到character_book.entries数组，包含 %d 个条目", len(entries))
+                for i, entry in enumerate(entries):
+                    trigger = self.process_entry(i, entry)
+                    if trigger:
+                        triggers.append(trigger)
+                        self.entries_processed += 1
+                return triggers
+
+            case "entries_dict":
+                # 情况1: 有entries字段，标准SillyTavern格式
+                logger.debug("找到entries字段，包含 %d 个条目", len(entries))
+                for entry_id, entry in entries.items():
+                    trigger = self.process_entry(entry_id, entry)
+                    if trigger:
+                        triggers.append(trigger)
+                        self.entries_processed += 1
+                return triggers
+
+            case "single_entry":
+                # 情况2: JSON具有常见的条目属性，作为单个条目处理
+                logger.debug("JSON具有条目属性，作为单个条目处理")
+                trigger = self.process_entry("1", entries)
                 if trigger:
                     triggers.append(trigger)
                     self.entries_processed += 1
-            
-            return triggers
-        
-        # 情况2: JSON具有常见的条目属性，作为单个条目处理
-        if any(key in data for key in ["keys", "comment", "content", "insertion_order"]):
-            logger.debug("JSON具有条目属性，作为单个条目处理")
-            trigger = self.process_entry("1", data)
-            if trigger:
-                triggers.append(trigger)
-                self.entries_processed += 1
-            return triggers
-        
+                return triggers
+
+        # 未识别的结构，依次尝试以下回退方式
         # 情况3: 尝试将JSON的每个顶级字段作为独立条目处理
         logger.debug("尝试将顶级字段作为独立条目处理")
         found_entries = False
@@ -324,43 +401,42 @@ class LoreBookConverter:
         
         except Exception as e:
             logger.error(f"转换JSON到YAML时出错: {e}")
-            logger.debug(traceback.format_exc())
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(traceback.format_exc())
             return False
     
-    def save_yaml_to_file(self, output_file: str) -> bool:
+    def _needs_python_emitter(self) -> bool:
+        """检查触发器中是否有 libyaml 与纯 Python 实现输出不同的字符串 (BMP 以外字符、代理字符、NEL/LS/PS、以换行结尾)"""
+        return any(
+            isinstance(value, str) and _LIBYAML_MISMATCH_RE.search(value)
+            for trigger in self.yaml_data["trigger"]
+            for value in trigger.values()
+        )
+
+    def save_yaml_to_file(self, output_file: Union[str, os.PathLike]) -> bool:
         """将YAML数据保存到文件"""
         try:
             # 确保输出目录存在
             output_dir = os.path.dirname(output_file)
             if output_dir and not os.path.exists(output_dir):
                 os.makedirs(output_dir, exist_ok=True)
-                logger.debug(f"创建输出目录: {output_dir}")
+                logger.debug("创建输出目录: %s", output_dir)
             
-            # 使用自定义 Dumper 来强制字符串使用双引号
-            class ForceDoubleQuoteDumper(yaml.SafeDumper):
-                def represent_scalar(self, tag, value, style=None):
-                    if isinstance(value, str):
-                        # 如果我们已经手动加了引号和转义，直接返回
-                        if value.startswith('"') and value.endswith('"'):
-                            if '\\n' in value[1:-1]: # 如果包含转义后的换行符，使用字面量块风格
-                                style = '|'
-                                processed_value = value[1:-1].replace('\\n', '\n').replace('\\"', '"')
-                                return super().represent_scalar(tag, processed_value, style=style)
-                            else:
-                                style = '"'
-                                return super().represent_scalar(tag, value[1:-1], style=style)
-                    return super().represent_scalar(tag, value, style)
-
             # 序列化YAML
+            if _CForceDoubleQuoteDumper is not None and not self._needs_python_emitter():
+                # libyaml 以负数表示不限制行宽
+                dumper, width = _CForceDoubleQuoteDumper, -1
+            else:
+                dumper, width = ForceDoubleQuoteDumper, float('inf')
             yaml_str = yaml.dump(
                 self.yaml_data, 
-                Dumper=ForceDoubleQuoteDumper, 
+                Dumper=dumper, 
                 allow_unicode=True, 
                 sort_keys=False, 
                 default_flow_style=False,
-                width=float('inf')
+                width=width
             )
-            logger.debug(f"YAML序列化结果大小: {len(yaml_str)} 字节")
+            logger.debug("YAML序列化结果大小: %d 字节", len(yaml_str))
             
             # 写入文件
             with open(output_file, 'w', encoding='utf-8') as yaml_file:
@@ -381,16 +457,17 @@ class LoreBookConverter:
             
         except Exception as e:
             logger.error(f"保存YAML文件时出错: {e}")
-            logger.debug(traceback.format_exc())
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(traceback.format_exc())
             return False
 
-def json_to_lorebook_yaml(json_input: Union[str, Dict[str, Any]], output_file: Optional[str] = None) -> Optional[str]:
+def json_to_lorebook_yaml(json_input: Union[str, Dict[str, Any]], output_file: Optional[Union[str, os.PathLike]] = None) -> Optional[str]:
     """
     将JSON文件或数据转换为astrbot_plugin_lorebook_lite插件支持的YAML格式
     
     参数:
     json_input: JSON文件路径(str) 或 JSON数据(dict)
-    output_file: 输出YAML文件的路径
+    output_file: 输出YAML文件的路径 (str 或 Path)
     
     返回:
     成功时返回输出文件路径，失败时返回None
@@ -414,7 +491,8 @@ def json_to_lorebook_yaml(json_input: Union[str, Dict[str, Any]], output_file: O
             try:
                 with open(json_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                logger.debug(f"成功读取JSON文件，大小: {os.path.getsize(json_file)} 字节")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("成功读取JSON文件，大小: %d 字节", os.path.getsize(json_file))
             except json.JSONDecodeError as e:
                 logger.error(f"错误: JSON解析失败 - {e}")
                 return None
@@ -427,7 +505,8 @@ def json_to_lorebook_yaml(json_input: Union[str, Dict[str, Any]], output_file: O
             data = json_input
             source_description = "JSON数据字典"
             logger.info(f"开始处理 {source_description}")
-            logger.debug(f"接收到的JSON数据大小: {len(json.dumps(data))} 字节")
+            if logger.isEnabledFor(logging.DEBUG): # 序列化整个数据代价较高，仅在调试时计算
+                logger.debug("接收到的JSON数据大小: %d 字节", len(json.dumps(data)))
             
         else:
             logger.error(f"错误: 无效的输入类型 {type(json_input)}，需要 str 或 dict")
@@ -452,14 +531,15 @@ def json_to_lorebook_yaml(json_input: Union[str, Dict[str, Any]], output_file: O
         if converter.convert_json_to_yaml(data, source_ref):
             if converter.save_yaml_to_file(output_file):
                 logger.info(f"从 {source_description} 到YAML转换成功: {output_file}")
-                return output_file
+                return os.fspath(output_file)
         
         logger.error(f"从 {source_description} 到YAML转换失败")
         return None
         
     except Exception as e:
         logger.error(f"处理过程中出现未处理的异常: {e}")
-        logger.debug(traceback.format_exc())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(traceback.format_exc())
         return None
 
 def main():
@@ -1,6 +1,8 @@
 import os
 import json
-from typing import Optional, Dict, Any, Tuple
+import asyncio
+import time
+from typing import Optional, Dict, Any, List, Tuple
 from pathlib import Path
 
 from astrbot.api.event import filter, AstrMessageEvent
@@ -8,29 +10,84 @@ from astrbot.api.star import Context, Star, register, StarTools
 from astrbot.api import logger
 import astrbot.api.message_components as Comp
 
-from .character_card_parser import parse_card
+# json_loads 可用时使用 orjson (其 JSONDecodeError 是 json.JSONDecodeError 的子类)
+from .character_card_parser import parse_card, json_loads
 from .json_to_lorebook_yaml import json_to_lorebook_yaml
 
+# 卡片中没有角色数据 (或载荷为空白) 时的提示
+_NO_CARD_DATA = "无法从PNG文件中提取角色数据"
+
+# 开场白候选字段，按优先级排列
+_FIRST_MES_KEYS = ('first_mes', 'begin_dialogs', 'greeting', 'example_dialog', 'char_greeting', 'alternate_greetings')
+
+# 转义表: 双引号 -> \", 换行符 -> \n, 移除 \r
+_QUOTE_TABLE = str.maketrans({'"': '\\"', '\n': '\\n', '\r': None})
+
+def _quote_value(value: str) -> str:
+    """为字符串添加双引号，并在一次遍历中转义内部引号和换行符"""
+    return f'"{value.translate(_QUOTE_TABLE)}"'
+
 @register("strbot_plugin_SillyTavern_card", "LKarxa", "一个将酒馆PNG角色卡卡转换为Lorebook YAML和角色TXT的插件", "1.0.0", "https://github.com/LKarxa/astrbot_plugin_SillyTavern_card")
 class CardConverterPlugin(Star):
+    # /help_convert 的帮助信息
+    _HELP_TEXT = """
+卡片转换插件使用帮助:
+
+1. 命令格式:
+   /convert_card [文件名] - 转换指定的角色卡片文件
+   /convert_cards - 批量转换卡片目录中的所有文件
+   /list_cards - 列出可用的卡片文件
+   /help_convert - 显示此帮助信息
+
+2. 说明:
+   - 请将角色卡片PNG文件放在插件目录的card文件夹中
+   - 使用 /convert_card 不带参数时会列出可用的文件
+   - 使用时只需提供文件名即可，不需要完整路径
+   
+3. 转换功能:
+   - 从PNG文件中提取角色卡片数据
+   - 将角色信息(name/description/begin_dialogs)保存为TX直接发给用户
+   - 按"entries"关键词切分JSON，将后部分转换为Lorebook的YAML格式
+   
+4. 输出文件:
+   - 转换后的YAML文件将保存在 data/lorebooks/ 目录下
+   - 两个文件均与原PNG文件同名
+
+字段映射关系:
+   - name → name
+   - description → prompt
+   - begin_dialogs → first_mes
+
+示例:
+   /convert_card character.png
+   或简写为:
+   /convert_card character
+"""
+
+    # 文件系统时间戳的最粗精度 (FAT 为 2 秒)
+    _MTIME_GRANULARITY_NS = 2_000_000_000
+
     def __init__(self, context: Context):
         super().__init__(context)
         # 使用 StarTools.get_data_dir 获取插件数据目录
         plugin_data_dir = StarTools.get_data_dir("strbot_plugin_SillyTavern_card")
-        self.data_dir = str(plugin_data_dir)
+        self.data_dir = Path(plugin_data_dir)
         
         # lorebook相关路径保持不变
-        self.output_dir = os.path.join(os.getcwd(), "data", "lorebooks")
+        self.output_dir = Path.cwd() / "data" / "lorebooks"
         
-        self.char_dir = os.path.join(self.data_dir, "characters")
+        self.char_dir = self.data_dir / "characters"
         
         # 创建card目录用于存放PNG文件
-        self.card_dir = os.path.join(self.data_dir, "card")
+        self.card_dir = self.data_dir / "card"
         
         # 确保所有必要的目录都存在
-        os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(self.char_dir, exist_ok=True)
-        os.makedirs(self.card_dir, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.char_dir.mkdir(parents=True, exist_ok=True)
+        self.card_dir.mkdir(parents=True, exist_ok=True)
+
+        # 卡片目录列表缓存: (目录 mtime_ns, 扫描时间 ns, PNG 文件名列表)
+        self._cards_cache: Optional[Tuple[int, int, List[str]]] = None
         
         logger.info(f"插件数据目录: {self.data_dir}")
         logger.info(f"卡片目录已创建: {self.card_dir}")
@@ -42,10 +99,9 @@ class CardConverterPlugin(Star):
         """将SillyTavern角色卡片PNG文件转换为Lorebook YAML和角色TXT"""
         # 如果没有提供文件名，列出可用的卡片文件
         if not filename:
-            files = [f for f in os.listdir(self.card_dir) if f.lower().endswith('.png')]
+            files = self._list_png_files()
             if not files:
-                yield event.plain_result("错误: 卡片目录中没有找到PNG文件")
-                yield event.plain_result(f"请将PNG文件放置在以下目录中: {self.card_dir}")
+                yield event.plain_result(f"错误: 卡片目录中没有找到PNG文件\n请将PNG文件放置在以下目录中: {self.card_dir}")
                 return
             
             # 列出可用的卡片文件
@@ -54,107 +110,172 @@ class CardConverterPlugin(Star):
             return
         
         # 构建完整的文件路径
+        # 只比较末尾 4 个字符来判断扩展名，无需将整个路径转为小写
+        has_png_suffix = filename[-4:].lower() == '.png'
         if os.path.isabs(filename):
-            # 如果提供的是绝对路径，直接使用
-            png_path = filename
+            # 如果提供的是绝对路径，直接使用，但不会自动补全后缀，需检查扩展名
+            if not has_png_suffix:
+                yield event.plain_result("错误: 文件必须是PNG格式")
+                return
+            png_path = Path(filename)
         else:
             # 否则，在卡片目录中查找文件
-            png_path = os.path.join(self.card_dir, filename)
             # 如果文件名没有.png后缀，自动添加
-            if not png_path.lower().endswith('.png'):
-                png_path += '.png'
+            if not has_png_suffix:
+                filename += '.png'
+            png_path = self.card_dir / filename
         
-        # 检查文件是否存在
-        if not os.path.isfile(png_path):
+        # 检查文件是否存在 (卡片目录可能位于网络存储上，放到线程中执行)
+        if not await asyncio.to_thread(os.path.isfile, png_path):
             yield event.plain_result(f"错误: 找不到文件 {png_path}")
             return
 
-        # 检查文件扩展名
-        if not png_path.lower().endswith('.png'):
-            yield event.plain_result("错误: 文件必须是PNG格式")
-            return
-
-        yield event.plain_result(f"开始处理PNG文件: {os.path.basename(png_path)}")
+        yield event.plain_result(f"开始处理PNG文件: {png_path.name}")
 
         try:
-            # 1. 从PNG文件中提取JSON数据
-            json_string = parse_card(png_path)
-            if not json_string:
-                yield event.plain_result("错误: 无法从PNG文件中提取角色数据")
-                return
-
-            # 2. 解析JSON数据
+            # 提取、解析和YAML转换都是阻塞操作，放到线程中执行以免阻塞事件循环
             try:
-                json_data = json.loads(json_string)
+                json_data, result_path = await asyncio.to_thread(self._convert_card_file, png_path)
             except json.JSONDecodeError as e:
-                yield event.plain_result(f"错误: JSON解析失败 - {e}")
+                yield event.plain_result(f"错误: JSON解析失败 - {e.msg} (第 {e.lineno} 行)")
+                return
+            if json_data is None:
+                yield event.plain_result(f"错误: {_NO_CARD_DATA}")
                 return
 
-            # 3. 处理JSON数据
-            results: Optional[Tuple[str, str]] = await self._process_json_data(png_path, json_data, event) 
-            if results:
-                yaml_result, txt_content = results
-                if txt_content:
-                    # 直接发送提取的角色信息文本
-                    yield event.plain_result(f"=== 角色卡信息 ===\n\n{txt_content}")
-                else:
-                    # 如果提取失败或内容为空
-                    yield event.plain_result("未能提取有效的角色信息文本。")
-                
-                # 然后发送YAML处理结果
-                yield event.plain_result(yaml_result)
+            txt_content = self._extract_character_info(json_data)
+            if txt_content:
+                # 直接发送提取的角色信息文本
+                yield event.plain_result(f"=== 角色卡信息 ===\n\n{txt_content}")
             else:
-                yield event.plain_result("处理失败，请检查日志")
+                # 如果提取失败或内容为空
+                yield event.plain_result("未能提取有效的角色信息文本。")
+
+            # 然后发送YAML处理结果
+            if result_path:
+                yield event.plain_result(f"成功! YAML文件已保存到: {result_path}")
+            else:
+                output_yaml_path = self._yaml_output_path(png_path)
+                logger.warning(f"JSON数据转YAML时出现问题，输出可能为空: {output_yaml_path}")
+                yield event.plain_result(f"警告: YAML文件可能未正确生成，请检查: {output_yaml_path}")
 
         except Exception as e:
             logger.error(f"处理PNG文件时出错: {e}")
-            yield event.plain_result(f"处理出错: {str(e)}")
+            yield event.plain_result(f"处理出错: {e}")
 
     @filter.command("list_cards")
     async def list_cards(self, event: AstrMessageEvent):
         """列出可用的卡片文件"""
-        files = [f for f in os.listdir(self.card_dir) if f.lower().endswith('.png')]
+        files = self._list_png_files()
         if not files:
-            yield event.plain_result("卡片目录中没有找到PNG文件")
-            yield event.plain_result(f"请将PNG文件放置在以下目录中: {self.card_dir}")
+            yield event.plain_result(f"卡片目录中没有找到PNG文件\n请将PNG文件放置在以下目录中: {self.card_dir}")
             return
         
         # 列出可用的卡片文件
         file_list = "\n".join(files)
-        yield event.plain_result(f"可用的卡片文件:\n{file_list}")
-        yield event.plain_result(f"\n使用命令 /convert_card <文件名> 来转换卡片")
+        yield event.plain_result(f"可用的卡片文件:\n{file_list}\n\n使用命令 /convert_card <文件名> 来转换卡片")
 
-    async def _process_json_data(self, png_path: str, json_data: Dict[str, Any], event: AstrMessageEvent) -> Optional[Tuple[str, str]]:
-        """处理JSON数据，转换为YAML并提取TXT内容字符串"""
-        basename = os.path.basename(png_path)
-        name = os.path.splitext(basename)[0]
-        
-        # 输出YAML文件路径
-        output_yaml_path = os.path.join(self.output_dir, f"{name}.yaml")
-        
-        yaml_result = ""
-        txt_content_result = ""
-        
-        # 1. 处理前半部分，提取角色信息为字符串
-        txt_content_result = await self._extract_character_info(json_data)
+    @filter.command("convert_cards")
+    async def convert_cards(self, event: AstrMessageEvent):
+        """批量转换卡片目录中的所有PNG文件为Lorebook YAML"""
+        files = self._list_png_files()
+        if not files:
+            yield event.plain_result(f"错误: 卡片目录中没有找到PNG文件\n请将PNG文件放置在以下目录中: {self.card_dir}")
+            return
+
+        # 仅扩展名大小写不同的文件 (如 a.png 与 a.PNG) 会写入同一个YAML文件，不参与转换，直接报告冲突
+        by_output: Dict[Path, List[str]] = {}
+        for name in files:
+            by_output.setdefault(self._yaml_output_path(Path(name)), []).append(name)
+        to_convert = []
+        conflicts = []
+        for output_yaml_path, names in by_output.items():
+            if len(names) == 1:
+                to_convert.append(names[0])
+                continue
+            for name in names:
+                others = "、".join(other for other in names if other != name)
+                conflicts.append((name, False, f"与 {others} 输出到同一个文件 {output_yaml_path.name}，已跳过"))
 
-        # 2. 处理后半部分，将整个JSON转换为YAML文件
+        # 各文件的解析与YAML转换互不依赖，放到线程中并发执行，用信号量限制同时运行的数量
+        sem = asyncio.Semaphore(os.cpu_count() or 4)
+        results = await asyncio.gather(*(self._convert_one(name, sem) for name in to_convert))
+        results.extend(conflicts)
+
+        succeeded = [f"  {name} → {detail}" for name, ok, detail in results if ok]
+        failed = [f"  {name}: {detail}" for name, ok, detail in results if not ok]
+        lines = [f"批量转换完成: 成功 {len(succeeded)} 个，失败 {len(failed)} 个"]
+        if succeeded:
+            lines.append("成功:")
+            lines.extend(succeeded)
+        if failed:
+            lines.append("失败:")
+            lines.extend(failed)
+        yield event.plain_result("\n".join(lines))
+
+    def _list_png_files(self) -> List[str]:
+        """
+        列出卡片目录中的PNG文件，目录未变化 (mtime 相同) 时直接返回缓存
+        FAT、部分网络文件系统和 HFS+ 的时间戳精度只有 1-2 秒，与缓存扫描处于同一时间片内新增的文件不会改变 mtime，
+        因此只有扫描时间比目录 mtime 晚至少 _MTIME_GRANULARITY_NS 的缓存才被信任
+        """
+        mtime_ns = os.stat(self.card_dir).st_mtime_ns
+        if self._cards_cache:
+            cached_mtime_ns, scanned_at_ns, cached_files = self._cards_cache
+            if cached_mtime_ns == mtime_ns and scanned_at_ns - mtime_ns >= self._MTIME_GRANULARITY_NS:
+                return cached_files
+
+        scanned_at_ns = time.time_ns()
+
+        with os.scandir(self.card_dir) as it:
+            # 只比较后缀的 4 个字符，避免为每个文件名生成小写副本；跳过名为 *.png 的目录
+            files = [entry.name for entry in it if entry.name[-4:].lower() == '.png' and entry.is_file()]
+        self._cards_cache = (mtime_ns, scanned_at_ns, files)
+        return files
+
+    def _yaml_output_path(self, png_path: Path) -> Path:
+        """输出YAML文件路径，与原PNG文件同名"""
+        return self.output_dir / f"{png_path.stem}.yaml"
+
+    def _convert_card_file(self, png_path: Path) -> Tuple[Any, Optional[str]]:
+        """
+        同步完成单个卡片的提取、JSON解析和YAML转换，供 /convert_card 和 /convert_cards 共用
+        返回 (角色卡JSON数据, YAML文件路径)：未找到角色数据时两者均为 None，
+        YAML文件未生成或为空时路径为 None。JSON解析失败时抛出 json.JSONDecodeError
+        """
+        # 从PNG文件中提取JSON数据 (UTF-8 字节串，直接交给 JSON 解析器)
+        json_bytes = parse_card(png_path)
+        # 空或仅含空白的载荷直接判定为无数据，省去一次 JSON 解析器调用
+        if not json_bytes or json_bytes.isspace():
+            return None, None
+
+        json_data = json_loads(json_bytes)
+        result_path = json_to_lorebook_yaml(json_data, self._yaml_output_path(png_path))
+
+        # 一次 stat 同时确认文件存在与大小
         try:
-            result_path = json_to_lorebook_yaml(json_data, output_yaml_path)
-            
-            if result_path and os.path.exists(result_path) and os.path.getsize(result_path) > 0:
-                yaml_result = f"成功! YAML文件已保存到: {result_path}"
-            else:
-                logger.warning(f"JSON数据转YAML时出现问题，输出可能为空: {output_yaml_path}")
-                yaml_result = f"警告: YAML文件可能未正确生成，请检查: {output_yaml_path}"
-                
-        except Exception as e:
-            logger.error(f"转换JSON数据到YAML过程中出错: {e}")
-            yaml_result = f"错误: 转换JSON数据到YAML失败 - {str(e)}"
-        
-        return yaml_result, txt_content_result
+            yaml_size = os.stat(result_path).st_size if result_path else 0
+        except OSError:
+            yaml_size = 0
+        return json_data, result_path if yaml_size > 0 else None
 
-    async def _extract_character_info(self, json_data: Dict[str, Any]) -> str:
+    async def _convert_one(self, filename: str, sem: asyncio.Semaphore) -> Tuple[str, bool, str]:
+        """在信号量限制下转换单个卡片文件，返回 (文件名, 是否成功, YAML路径或错误信息)"""
+        async with sem:
+            try:
+                json_data, result_path = await asyncio.to_thread(self._convert_card_file, self.card_dir / filename)
+            except json.JSONDecodeError as e:
+                return filename, False, f"JSON解析失败 - {e.msg} (第 {e.lineno} 行)"
+            except Exception as e:
+                logger.error(f"批量转换 {filename} 时出错: {e}")
+                return filename, False, f"处理出错: {e}"
+        if json_data is None:
+            return filename, False, _NO_CARD_DATA
+        if not result_path:
+            return filename, False, "YAML文件可能未正确生成"
+        return filename, True, result_path
+
+    def _extract_character_info(self, json_data: Dict[str, Any]) -> str:
         """
         从JSON数据中提取角色信息并返回格式化后的字符串
         映射关系：
@@ -168,38 +289,20 @@ class CardConverterPlugin(Star):
             description = str(json_data.get('description', ''))
             first_mes_raw = ""
             
-            if 'first_mes' in json_data:
-                first_mes_raw = json_data['first_mes']
-            elif 'begin_dialogs' in json_data:
-                begin_dialogs = json_data['begin_dialogs']
-                if isinstance(begin_dialogs, list) and begin_dialogs:
-                    first_mes_raw = begin_dialogs[0]
-                elif isinstance(begin_dialogs, str):
-                    first_mes_raw = begin_dialogs
-            elif 'greeting' in json_data:
-                first_mes_raw = json_data['greeting']
-            elif 'example_dialog' in json_data and json_data['example_dialog']:
-                example_dialog = json_data['example_dialog']
-                if isinstance(example_dialog, list) and example_dialog:
-                    first_mes_raw = example_dialog[0]
-            elif 'char_greeting' in json_data:
-                first_mes_raw = json_data['char_greeting']
-            elif 'alternate_greetings' in json_data and json_data['alternate_greetings']:
-                alternate_greetings = json_data['alternate_greetings']
-                if isinstance(alternate_greetings, list) and alternate_greetings:
-                    first_mes_raw = alternate_greetings[0]
+            # 按优先级取第一个非空的开场白字段，列表取第一项
+            for key in _FIRST_MES_KEYS:
+                value = json_data.get(key)
+                if not value:
+                    continue
+                first_mes_raw = value[0] if isinstance(value, list) else value
+                break
             first_mes = str(first_mes_raw)
 
-            def quote_value(value: str) -> str:
-                escaped_value = value.replace('"', '\\"')
-                escaped_value = escaped_value.replace('\n', '\\n').replace('\r', '') 
-                return f'"{escaped_value}"'
-
-            txt_content = f"name: {quote_value(name)}\n\n"
-            txt_content += f"prompt: {quote_value(description)}\n\n"
-            txt_content += f"first_mes: {quote_value(first_mes)}"
-            
-            return txt_content
+            return (
+                f"name: {_quote_value(name)}\n\n"
+                f"prompt: {_quote_value(description)}\n\n"
+                f"first_mes: {_quote_value(first_mes)}"
+            )
             
         except Exception as e:
             logger.error(f"提取角色信息时出错: {e}")
@@ -208,36 +311,4 @@ class CardConverterPlugin(Star):
     @filter.command("help_convert")
     async def help_convert(self, event: AstrMessageEvent):
         """显示卡片转换插件的使用说明"""
-        help_text = """
-卡片转换插件使用帮助:
-
-1. 命令格式:
-   /convert_card [文件名] - 转换指定的角色卡片文件
-   /list_cards - 列出可用的卡片文件
-   /help_convert - 显示此帮助信息
-
-2. 说明:
-   - 请将角色卡片PNG文件放在插件目录的card文件夹中
-   - 使用 /convert_card 不带参数时会列出可用的文件
-   - 使用时只需提供文件名即可，不需要完整路径
-   
-3. 转换功能:
-   - 从PNG文件中提取角色卡片数据
-   - 将角色信息(name/description/begin_dialogs)保存为TX直接发给用户
-   - 按"entries"关键词切分JSON，将后部分转换为Lorebook的YAML格式
-   
-4. 输出文件:
-   - 转换后的YAML文件将保存在 data/lorebooks/ 目录下
-   - 两个文件均与原PNG文件同名
-
-字段映射关系:
-   - name → name
-   - description → prompt
-   - begin_dialogs → first_mes
-
-示例:
-   /convert_card character.png
-   或简写为:
-   /convert_card character
-"""
-        yield event.plain_result(help_text)
\ No newline at end of file
+        yield event.plain_result(self._HELP_TEXT)
\ No newline at end of file